@@ -2,14 +2,157 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import math
-import plotly.express as px
+import plotly.graph_objects as go
 from io import BytesIO
+from numba import njit
+from pandas.api.types import is_datetime64_any_dtype
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import (SimpleDocTemplate, Paragraph, Spacer,
                                 Table, TableStyle, Image)
 
+# Row-mask slices below are only read or given new columns; copy-on-write makes them free.
+if int(pd.__version__.split('.')[0]) < 3:  # always on from pandas 3
+    pd.options.mode.copy_on_write = True
+
+REQUIRED_COLS = ['T(X)', 'T(Y)', 'T(Z)', 'X', 'Y', 'Z']
+
+
+# Bounded: cached uploads are shared across sessions and would otherwise live as long as the server.
+@st.cache_resource(show_spinner=False, max_entries=8, ttl="1h")
+def open_workbook(raw_bytes):
+    """One ExcelFile handle per upload, shared by sheet listing and parsing."""
+    return pd.ExcelFile(BytesIO(raw_bytes), engine="calamine")
+
+
+@st.cache_data(show_spinner="Reading file …", max_entries=32, ttl="1h")
+def parse_file(raw_bytes, name, sheet):
+    """Load one file/sheet and return (df_use, sparse); df_use is None if columns are missing."""
+    if name.endswith(".csv"):
+        try:
+            df = pd.read_csv(BytesIO(raw_bytes), engine='pyarrow', usecols=REQUIRED_COLS,
+                             parse_dates=['T(X)', 'T(Y)', 'T(Z)'])
+        except Exception:
+            # e.g. missing columns: the C engine read below lets the checks report it.
+            df = None
+        # pyarrow converts offset-aware timestamps to UTC; read those with the C engine
+        # so pd.to_datetime below keeps the recorded offset.
+        if df is None or any(isinstance(df[c].dtype, pd.DatetimeTZDtype)
+                             for c in ('T(X)', 'T(Y)', 'T(Z)')):
+            df = pd.read_csv(BytesIO(raw_bytes))
+    else:
+        df = open_workbook(raw_bytes).parse(sheet)
+
+    if not all(col in df.columns for col in REQUIRED_COLS):
+        return None, False
+
+    times = {c: df[c] if is_datetime64_any_dtype(df[c])
+             else pd.to_datetime(df[c], errors='coerce', cache=True)
+             for c in ('T(X)', 'T(Y)', 'T(Z)')}
+    valid = np.logical_and.reduce([t.notna().to_numpy() for t in times.values()])
+    df = df.iloc[valid].assign(**{c: t[valid] for c, t in times.items()})
+
+    df_filtered = df.iloc[(df[['X', 'Y', 'Z']].to_numpy() >= 0.5).all(axis=1)]
+
+    sparse = len(df_filtered) <= 1
+    if sparse:
+        df_filtered = df
+    df_use = df_filtered.rename(columns={'T(X)': 't', 'X': 'x', 'Y': 'y', 'Z': 'z'})[['t', 'x', 'y', 'z']]
+    if not df_use['t'].is_monotonic_increasing:
+        df_use = df_use.sort_values('t', kind='stable')
+    return df_use, sparse
+
+
+# Diagnosis bits written by rms_diagnose(); DIAG_TEXT maps every bit combination to its note.
+RADIAL_WARN, AXIAL_WARN, LOOSENESS = 1, 2, 4
+DIAG_NOTES = {RADIAL_WARN: "🔧 Radial RMS ≥ 85 % (possible unbalance/misalignment)",
+              AXIAL_WARN: "📏 Axial RMS ≥ 85 % (possible axial load/misalignment)",
+              LOOSENESS: "🔩 |Radial axis RMS difference| > 0.2 (possible looseness)"}
+DIAG_TEXT = np.array(["; ".join(note for bit, note in DIAG_NOTES.items() if code & bit) or "✅ Normal"
+                      for code in range(8)], dtype=object)
+
+
+@njit(cache=True)
+def rms_diagnose(vals, win, warn, axial_idx, rad0_idx, rad1_idx):
+    """Rolling RMS of the (N, 3) x/y/z block and the diagnosis bits per row, in a single pass.
+
+    Non-finite samples are left out of their window; a window with no valid samples gives NaN.
+    """
+    n = vals.shape[0]
+    rms = np.empty((n, 3))
+    codes = np.zeros(n, np.int8)
+    sums = np.zeros(3)
+    counts = np.zeros(3, np.int64)
+    for i in range(n):
+        for k in range(3):
+            v = float(vals[i, k])
+            if np.isfinite(v):
+                sums[k] += v * v
+                counts[k] += 1
+            if i >= win:
+                old = float(vals[i - win, k])
+                if np.isfinite(old):
+                    sums[k] -= old * old
+                    counts[k] -= 1
+            if counts[k] > 0:
+                rms[i, k] = np.sqrt(max(sums[k], 0.0) / counts[k])
+            else:
+                sums[k] = 0.0
+                rms[i, k] = np.nan
+
+        # Samples are float32, so compare at float32 precision against float32 thresholds:
+        # a steady 2.63 signal must not exceed a 2.63 threshold through rounding noise.
+        code = 0
+        if (np.float32(rms[i, rad0_idx]) > warn[rad0_idx]
+                or np.float32(rms[i, rad1_idx]) > warn[rad1_idx]):
+            code |= RADIAL_WARN
+        if np.float32(rms[i, axial_idx]) > warn[axial_idx]:
+            code |= AXIAL_WARN
+        if abs(rms[i, rad0_idx] - rms[i, rad1_idx]) > 0.2:
+            code |= LOOSENESS
+        codes[i] = code
+    return rms, codes
+
+
+@st.cache_data(show_spinner="Computing RMS diagnosis …", max_entries=16, ttl="1h")
+def compute_diagnosis(data, win, axial_axis, percentiles):
+    axes = ['x', 'y', 'z']
+    a = axes.index(axial_axis)
+    r0, r1 = [i for i in range(3) if i != a]
+    warn = np.array([percentiles[ax]['warning'] for ax in axes], dtype=np.float32)
+    vals = np.ascontiguousarray(data[axes].to_numpy(dtype=np.float32))
+    rms, codes = rms_diagnose(vals, win, warn, a, r0, r1)
+
+    return pd.DataFrame({'t': data['t'].to_numpy(), 'x_rms': rms[:, 0], 'y_rms': rms[:, 1],
+                         'z_rms': rms[:, 2], 'code': codes})
+
+
+def decimate(df, max_points):
+    """Every n-th row so that at most about max_points rows remain."""
+    stride = 1 if len(df) <= max_points else len(df) // max_points
+    return df.iloc[::stride]
+
+
+def build_plot(df, plot_axis, percentiles, max_points=200_000):
+    """WebGL line of one axis with its warning/error thresholds."""
+    df = decimate(df, max_points)
+    fig = go.Figure(go.Scattergl(x=df['t'], y=df[plot_axis], mode='lines'))
+    fig.update_layout(title=f"{plot_axis.upper()} vibration with thresholds",
+                      xaxis_title='Timestamp', yaxis_title=f"{plot_axis.upper()} amplitude")
+    fig.add_hline(percentiles[plot_axis]['warning'], line_dash='dash', line_color='orange',
+                  annotation_text="85 % warn", annotation_position="top left")
+    fig.add_hline(percentiles[plot_axis]['error'], line_dash='dot', line_color='red',
+                  annotation_text="95 % error", annotation_position="top left")
+    return fig
+
+
+@st.cache_data(show_spinner="Rendering chart …", max_entries=16, ttl="1h")
+def render_plot_png(plot_df, plot_axis, percentiles):
+    """Kaleido PNG of build_plot() for the PDF; plot_df is already decimated, so hashing it is cheap."""
+    return build_plot(plot_df, plot_axis, percentiles).to_image(format="png")
+
+
 # Page & title
 st.set_page_config(page_title="📊 Vibration Threshold & RMS Diagnosis", layout="wide")
 st.title("📊 Vibration Threshold & RMS-Based Fault Diagnosis")
@@ -18,20 +161,29 @@ uploaded = st.file_uploader("📂 Upload one or more vibration files", type=["cs
                             accept_multiple_files=True)
 
 if uploaded:
-    sheet_choice = {}
-    for file in uploaded:
-        if file.name.endswith(".csv"):
-            sheet_choice[file.name] = "CSV Data"
-        else:
-            try:
-                xls = pd.ExcelFile(file)
-                sheet_choice[file.name] = st.selectbox(
-                    f"Select sheet from {file.name}",
-                    ["-- Select a sheet --"] + xls.sheet_names,
-                    key=file.name
-                )
-            except Exception as e:
-                st.error(f"Error reading {file.name}: {e}")
+    sheet_choice = {f.name: "CSV Data" for f in uploaded if f.name.endswith(".csv")}
+    excel_files = [f for f in uploaded if not f.name.endswith(".csv")]
+
+    if excel_files:
+        # Sheet picks are batched in a form, so changing one selectbox doesn't rerun the pipeline.
+        with st.form("sheet_pick"):
+            for file in excel_files:
+                try:
+                    sheet_choice[file.name] = st.selectbox(
+                        f"Select sheet from {file.name}",
+                        ["-- Select a sheet --"] + open_workbook(file.getvalue()).sheet_names,
+                        key=file.name
+                    )
+                except Exception as e:
+                    st.error(f"Error reading {file.name}: {e}")
+            submitted = st.form_submit_button("▶️ Process")
+
+        upload_key = tuple((f.name, f.size) for f in uploaded)
+        if submitted:
+            st.session_state["processed_uploads"] = upload_key
+        elif st.session_state.get("processed_uploads") != upload_key:
+            st.info("📑 Choose a sheet for every uploaded Excel, then press Process.")
+            st.stop()
 
     if not all(val and val != "-- Select a sheet --" for val in sheet_choice.values()):
         st.info("📑 Please choose a sheet for every uploaded Excel.")
@@ -42,29 +194,15 @@ if uploaded:
 
     for file in uploaded:
         sheet = sheet_choice[file.name]
-        if file.name.endswith(".csv"):
-            df = pd.read_csv(file)
-            file_sheet_pairs.append((file.name, "CSV Data"))
-        else:
-            df = pd.read_excel(file, sheet_name=sheet)
-            file_sheet_pairs.append((file.name, sheet))
-
-        if not all(col in df.columns for col in ['T(X)', 'T(Y)', 'T(Z)', 'X', 'Y', 'Z']):
+        file_sheet_pairs.append((file.name, sheet))
+        df_use, sparse = parse_file(file.getvalue(), file.name, sheet)
+
+        if df_use is None:
             st.warning(f"Skipping {file.name}/{sheet} (columns missing).")
             continue
-
-        df[['T(X)', 'T(Y)', 'T(Z)']] = df[['T(X)', 'T(Y)', 'T(Z)']].apply(
-            pd.to_datetime, errors='coerce')
-        df = df.dropna(subset=['T(X)', 'T(Y)', 'T(Z)'])
-
-        df_filtered = df[(df[['X', 'Y', 'Z']] >= 0.5).all(axis=1)]
-
-        if len(df_filtered) <= 1:
+        if sparse:
             st.warning(f"⚠️ Very few usable rows after filtering in {file.name}/{sheet}. "
                        "Using all available data for calculation.")
-            df_use = df.rename(columns={'T(X)': 't', 'X': 'x', 'Y': 'y', 'Z': 'z'})[['t', 'x', 'y', 'z']]
-        else:
-            df_use = df_filtered.rename(columns={'T(X)': 't', 'X': 'x', 'Y': 'y', 'Z': 'z'})[['t', 'x', 'y', 'z']]
 
         frames.append(df_use)
 
@@ -72,16 +210,20 @@ if uploaded:
         st.error("❌ No usable data.")
         st.stop()
 
-    data = pd.concat(frames).sort_values('t').reset_index(drop=True)
+    # Each frame is already sorted by t, so a stable (timsort) sort only has to merge the runs.
+    data = pd.concat(frames, ignore_index=True)
+    if len(frames) > 1:
+        data = data.sort_values('t', kind='stable', ignore_index=True)
 
     st.markdown(f"**Dataset coverage:** {data['t'].min()} → {data['t'].max()} "
                 f"({len(data):,} rows)")
 
+    q = data[['x', 'y', 'z']].quantile([0.85, 0.95]).to_numpy()
     percentiles = {
         axis: {
-            "warning": math.ceil(data[axis].quantile(0.85) * 100) / 100,
-            "error": math.ceil(data[axis].quantile(0.95) * 100) / 100
-        } for axis in ['x', 'y', 'z']
+            "warning": math.ceil(q[0, i] * 100) / 100,
+            "error": math.ceil(q[1, i] * 100) / 100
+        } for i, axis in enumerate(['x', 'y', 'z'])
     }
 
     st.subheader("🎯 85th / 95th-Percentile Thresholds")
@@ -96,40 +238,22 @@ if uploaded:
     axial_axis = st.selectbox("📌 Select axial axis", ['x', 'y', 'z'], index=2)
     plot_axis = st.selectbox("📌 Axis to plot", ['x', 'y', 'z'], index=0)
 
-    plot_df = data.iloc[::max(1, len(data)//5000)]
-    fig = px.line(plot_df, x='t', y=plot_axis,
-                  title=f"{plot_axis.upper()} vibration with thresholds",
-                  labels={'t': 'Timestamp', plot_axis: f"{plot_axis.upper()} amplitude"})
-    fig.add_hline(percentiles[plot_axis]['warning'], line_dash='dash', line_color='orange',
-                  annotation_text="85 % warn", annotation_position="top left")
-    fig.add_hline(percentiles[plot_axis]['error'], line_dash='dot', line_color='red',
-                  annotation_text="95 % error", annotation_position="top left")
+    fig = build_plot(data, plot_axis, percentiles)
     st.plotly_chart(fig, use_container_width=True)
 
     win = 10
-    diag_df = data.copy()
-    for axis in ['x', 'y', 'z']:
-        diag_df[f'{axis}_rms'] = diag_df[axis].rolling(win, min_periods=1)\
-                                             .apply(lambda v: np.sqrt(np.mean(v**2)), raw=True)
-
-    def judge(row):
-        notes = []
-        radial_axes = [ax for ax in ['x', 'y', 'z'] if ax != axial_axis]
-        if any(row[f'{ax}_rms'] > percentiles[ax]['warning'] for ax in radial_axes):
-            notes.append("🔧 Radial RMS ≥ 85 % (possible unbalance/misalignment)")
-        if row[f'{axial_axis}_rms'] > percentiles[axial_axis]['warning']:
-            notes.append("📏 Axial RMS ≥ 85 % (possible axial load/misalignment)")
-        if abs(row[f'{radial_axes[0]}_rms'] - row[f'{radial_axes[1]}_rms']) > 0.2:
-            notes.append("🔩 |Radial axis RMS difference| > 0.2 (possible looseness)")
-        return "✅ Normal" if not notes else "; ".join(notes)
-
-    diag_df['Diagnosis'] = diag_df.apply(judge, axis=1)
+    diag_df = compute_diagnosis(data, win, axial_axis, percentiles)
+
+    # Diagnosis strings are only materialised for the rows actually shown.
+    diag_tail = diag_df[['t', 'x_rms', 'y_rms', 'z_rms', 'code']].tail(50)
+    diag_tail = diag_tail.assign(Diagnosis=DIAG_TEXT[diag_tail.pop('code').to_numpy()])
 
     st.subheader("📋 Last 50 diagnosed rows")
-    st.dataframe(diag_df[['t', 'x_rms', 'y_rms', 'z_rms', 'Diagnosis']].tail(50))
+    st.dataframe(diag_tail)
 
     if st.button("📄 Generate PDF Report"):
-        plot_bytes = fig.to_image(format="png")
+        # Static export gets no WebGL speed-up, so decimate to ~5000 points for kaleido.
+        plot_bytes = render_plot_png(decimate(data, 5000), plot_axis, percentiles)
         pdf_buf = BytesIO()
         doc = SimpleDocTemplate(pdf_buf, pagesize=letter)
         styles = getSampleStyleSheet()
@@ -177,14 +301,12 @@ if uploaded:
         flow.append(img)
         flow.append(Spacer(1, 12))
 
-        diag_rows = diag_df[['t', 'x_rms', 'y_rms', 'z_rms', 'Diagnosis']].tail(20)
+        diag_rows = diag_tail.tail(20)
         pdf_table = [['Time', 'X RMS', 'Y RMS', 'Z RMS', 'Diagnosis']]
-        for _, r in diag_rows.iterrows():
-            pdf_table.append([r['t'].strftime('%Y-%m-%d %H:%M:%S'),
-                              f"{r['x_rms']:.3f}",
-                              f"{r['y_rms']:.3f}",
-                              f"{r['z_rms']:.3f}",
-                              r['Diagnosis']])
+        pdf_table.extend(map(list, zip(diag_rows['t'].dt.strftime('%Y-%m-%d %H:%M:%S'),
+                                       *(np.char.mod('%.3f', diag_rows[c].to_numpy())
+                                         for c in ('x_rms', 'y_rms', 'z_rms')),
+                                       diag_rows['Diagnosis'])))
         dtbl = Table(pdf_table, repeatRows=1, colWidths=[85, 45, 45, 45, 210])
         dtbl.setStyle(TableStyle([
             ('BACKGROUND', (0, 0), (-1, 0), colors.grey),